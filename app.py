@@ -1,34 +1,49 @@
 import streamlit as st
-import pandas as pd
-from datetime import datetime
+import numpy as np
 import re
 import io
-import uuid
+from secrets import token_hex
 import json
 import os
 import time
-import requests
+import threading
+import heapq
+from importlib.util import find_spec
 
-# Import libraries with error handling
-try:
-    from PyPDF2 import PdfReader
-    PDF_SUPPORT = True
-except ImportError:
-    PDF_SUPPORT = False
-    st.warning("PyPDF2 not installed. PDF uploads will not work.")
+# Document, report and HTTP libraries are only imported where they are used, so a cold
+# start does not pay for them; find_spec checks they are installed without importing
+PYMUPDF_SUPPORT = find_spec("fitz") is not None  # PyMuPDF, preferred for its much faster text extraction
+PYPDF2_SUPPORT = find_spec("PyPDF2") is not None
+
+PDF_SUPPORT = PYMUPDF_SUPPORT or PYPDF2_SUPPORT
+if not PDF_SUPPORT:
+    st.warning("PyMuPDF or PyPDF2 not installed. PDF uploads will not work.")
+
+DOCX_SUPPORT = find_spec("docx") is not None
+if not DOCX_SUPPORT:
+    st.warning("python-docx not installed. DOCX uploads will not work.")
 
 try:
-    from docx import Document
-    DOCX_SUPPORT = True
+    import orjson  # Optional: faster JSON serialization
+    ORJSON_SUPPORT = True
 except ImportError:
-    DOCX_SUPPORT = False
-    st.warning("python-docx not installed. DOCX uploads will not work.")
+    ORJSON_SUPPORT = False
+
+# Both parse UTF-8 bytes, so data files are read in binary mode
+json_loads = orjson.loads if ORJSON_SUPPORT else json.loads
 
 # File paths for persistence
 QUIZZES_FILE = "quizzes.json"
-STUDENT_RECORDS_FILE = "student_records.json"
+STUDENT_RECORDS_FILE = "student_records.jsonl"  # one JSON record per line, append-only
+LEGACY_STUDENT_RECORDS_FILE = "student_records.json"  # JSON array used by older versions
 COUNTER_FILE = "counter.json"
 
+# Column headings of the Excel results report
+REPORT_COLUMNS = (
+    'Student ID', 'Student Name', 'Student Email', 'Quiz Title',
+    'Date/Time', 'Score', 'Total Questions', 'Percentage'
+)
+
 # Authentication credentials
 ADMIN_CREDENTIALS = {
     "admin": "Admin123"
@@ -37,38 +52,303 @@ ADMIN_CREDENTIALS = {
 # Free AI API configurations (optional - works without API keys too)
 HUGGINGFACE_API_URL = "https://api-inference.huggingface.co/models/microsoft/DialoGPT-large"
 HUGGINGFACE_API_KEY = ""  # Optional: Add your free API key
+HUGGINGFACE_TIMEOUT_SECONDS = 30
+HUGGINGFACE_MAX_ATTEMPTS = 3  # retries back off 1s, 2s while the model is loading or rate limited
+
+# Precompiled patterns for document parsing
+_SENT_SPLIT_RE = re.compile(r'[.!?]+')
+
+# Precompiled patterns for AI responses
+_QUESTION_PREFIX_RE = re.compile(r'^question:\s*', re.IGNORECASE)
+_OPTION_PREFIX_RE = re.compile(r'^[A-D][).]\s*', re.IGNORECASE)
+_CORRECT_PREFIX_RE = re.compile(r'^correct:\s*', re.IGNORECASE)
+
+# Common words skipped when picking key terms for generated questions
+_STOPWORDS = frozenset({'which', 'about', 'there', 'their', 'would', 'could'})
+
+# Templates for generated questions; only the chosen ones are formatted per question
+_QUESTION_TEMPLATES = (
+    "What is the main idea conveyed in this text?",
+    "What key concept is discussed in this passage?",
+    "Based on the text, what is the primary focus?",
+    "What important information does this text provide?",
+)
+_ENHANCED_OPTION_TEMPLATES = (
+    "The text discusses {0} concepts and their significance",
+    "It focuses on {1} aspects and related details",
+    "The passage describes general information without specific focus",
+    "It explains technical details about {2} topics",
+)
+_BASIC_OPTIONS = (
+    "The text discusses key concepts and important information",
+    "It focuses on specific details and technical aspects",
+    "The passage provides general background and context",
+    "It explains complex ideas in simple terms",
+)
+
+# How often the server re-checks a running quiz; the visible countdown is client-side
+TIMER_POLL_SECONDS = 5
+
+# How long an open session waits past the deadline for the browser to submit the answer
+# form itself: several polls plus network latency. A server-side rerun cannot see
+# unsubmitted form values, so a quiz still open after this is ended without a score
+FORM_SUBMIT_GRACE_SECONDS = 30
+
+# Extra time the server waits past a deadline before expiring an attempt on its own,
+# for closed tabs; longer than the form grace so an open session settles its attempt first
+AUTO_SUBMIT_GRACE_SECONDS = FORM_SUBMIT_GRACE_SECONDS + 30
+
+# Quiz timer markup; the countdown itself runs client-side from the time left
+_TIMER_HTML = """
+<style>
+    body {{ margin: 0; font-family: Arial, sans-serif; }}
+    .timer-container {{ background: #4CAF50; color: white; padding: 15px; border-radius: 10px; text-align: center; border: 2px solid #45a049; }}
+    .timer-warning {{ background: #FF9800; border-color: #ffb74d; }}
+    .timer-danger {{ background: #ff4444; border-color: #ff6b6b; }}
+    .timer-refresh {{ margin-top: 8px; width: 100%; padding: 6px; border: none; border-radius: 8px; background: #ff4b4b; color: white; font-weight: bold; cursor: pointer; }}
+</style>
+<div id="timer" class="timer-container">
+    <div style="font-size: 14px; font-weight: bold; margin-bottom: 5px;">⏰ QUIZ TIMER</div>
+    <div style="font-size: 18px; font-weight: bold; font-family: 'Courier New', monospace; margin-bottom: 3px;">
+        <span id="mm">--</span>:<span id="ss">--</span>
+    </div>
+    <div style="font-size: 11px; opacity: 0.9;">
+        {duration_minutes} minute quiz
+    </div>
+</div>
+<button class="timer-refresh" onclick="tick()">🔄 Refresh Timer Now</button>
+<script>
+    // The deadline is measured on the browser's own clock, so a skewed client clock
+    // does not move it. It is kept in the page's session storage under the attempt id,
+    // so a rebuilt frame continues the countdown instead of restarting it
+    const deadlineKey = "quiz-deadline-{attempt_id}";
+    let end = Date.now() + {remaining_ms};
+    try {{
+        const saved = Number(window.parent.sessionStorage.getItem(deadlineKey));
+        if (saved) {{
+            end = saved;
+        }} else {{
+            window.parent.sessionStorage.setItem(deadlineKey, String(end));
+        }}
+    }} catch (e) {{}}
+    const warnAt = {warn_ms};
+    const timer = document.getElementById("timer");
+    let submitted = false;
+    function tick() {{
+        const r = Math.max(0, end - Date.now());
+        if (r <= 0 && !submitted) {{
+            // Submit from background tabs too, before the visibility check below
+            submitted = true;
+            clearInterval(handle);
+            submitQuiz();
+        }}
+        // Background tabs skip DOM work and resync once visible again
+        if (document.visibilityState !== "visible") return;
+        document.getElementById("mm").textContent = String(Math.floor(r / 60000)).padStart(2, "0");
+        document.getElementById("ss").textContent = String(Math.floor(r / 1000) % 60).padStart(2, "0");
+        timer.className = "timer-container" + (r < 60000 ? " timer-danger" : r < warnAt ? " timer-warning" : "");
+    }}
+    function submitQuiz() {{
+        // Lock the answers at zero, then press the page's Submit button so the deadline
+        // triggers one rerun right away; a late submit is still scored with these answers
+        try {{
+            for (const input of window.parent.document.querySelectorAll('input[type="radio"]')) {{
+                input.disabled = true;
+            }}
+            for (const button of window.parent.document.querySelectorAll("button")) {{
+                if (button.innerText.trim() === "Submit Quiz") {{
+                    button.click();
+                    return;
+                }}
+            }}
+        }} catch (e) {{}}
+    }}
+    // Sub-second ticks keep the display from lagging up to a second behind the deadline
+    const handle = setInterval(tick, 250);
+    // Hidden tabs may throttle the interval heavily; a single timeout still fires near the deadline
+    setTimeout(tick, Math.max(0, end - Date.now()));
+    document.addEventListener("visibilitychange", tick);
+    tick();
+</script>
+"""
+
+# Page styles and header, emitted on every rerun (Streamlit drops elements a rerun does not redraw)
+_STYLE_HTML = """
+<style>
+    .main-header {
+        text-align: center;
+        color: #1f77b4;
+        padding: 20px;
+    }
+    .quiz-container {
+        border: 2px solid #2196F3;
+        border-radius: 10px;
+        padding: 20px;
+        margin: 10px 0;
+        background: #f0f8ff;
+    }
+</style>
+"""
+_HEADER_HTML = """
+<div class="main-header">
+    <h1>🎯 Digital Pakistan Quiz Management System</h1>
+    <p><strong>Teacher Panel:</strong> Upload quiz documents and set correct answers<br>
+    <strong>Student Panel:</strong> Take quizzes and view results</p>
+</div>
+"""
+_PAGE_CHROME_HTML = _STYLE_HTML + _HEADER_HTML
+
+# Result card shown to a student after submitting
+RESULT_TEMPLATE = """
+    <div style="padding: 20px; border: 2px solid #4CAF50; border-radius: 10px; background: #f9fff9;">
+        <h3 style="color: #4CAF50; text-align: center;">🎉 Quiz Completed!</h3>
+        <div style="text-align: center; margin: 20px 0;">
+            <h2>Score: {score}/{total_questions} ({percentage}%)</h2>
+        </div>
+        <div style="background: white; padding: 15px; border-radius: 8px;">
+            <p><strong>Name:</strong> {student_name}</p>
+            <p><strong>Email:</strong> {student_email}</p>
+            <p><strong>Quiz:</strong> {quiz_title}</p>
+            <p><strong>Date/Time:</strong> {timestamp}</p>
+        </div>
+    </div>
+    """
+
+# Shown when the deadline passed before the student's answers reached the server
+QUIZ_EXPIRED_HTML = """
+        <div style="padding: 20px; border: 2px solid #FF9800; border-radius: 10px; background: #fffaf0;">
+            <h3 style="color: #FF9800; text-align: center;">⏰ Time ran out</h3>
+            <p style="text-align: center;">Your answers were not submitted before the deadline, so no score was recorded.</p>
+        </div>
+        """
+
+# Header of the teacher's answer editor
+TEACHER_QUIZ_INFO_TEMPLATE = """
+                <div style="padding: 15px; border: 2px solid #4CAF50; border-radius: 10px; background: #f9fff9; margin-bottom: 20px;">
+                    <h4>🎯 Setting Correct Answers: {title}</h4>
+                    <p><strong>Total Questions:</strong> {total_questions} | <strong>Duration:</strong> {duration_minutes} minutes</p>
+                </div>
+                """
+
+# Header shown above the questions of the quiz a student is taking
+QUIZ_HEADER_TEMPLATE = """
+                <div class="quiz-container">
+                    <h3>📝 Taking Quiz: {title}</h3>
+                    <p><strong>Total Questions:</strong> {total_questions} | <strong>Time Allowed:</strong> {duration_minutes} minutes</p>
+                    <p><em>The timer counts down in your browser. Use the 'Refresh Timer Now' button above to resync the display.</em></p>
+                </div>
+                """
 
 # Global variables to store data
 quizzes_dict = {}
 student_records = []
 quiz_counter = 0
 
+# The file readers below are cached across sessions and keyed by modification time,
+# so a change on disk is parsed once per process rather than once per session;
+# max_entries drops the copies of older versions
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=4)
+def read_quizzes_file(mtime_ns):
+    """Parse the quizzes file; the modification time is the cache key"""
+    with open(QUIZZES_FILE, 'rb') as f:
+        return json_loads(f.read())
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_json_file(path, mtime_ns):
+    """Parse a JSON data file; the modification time is part of the cache key"""
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+def session_cached(path, read, default):
+    """Return this session's parsed copy of a data file, calling read(mtime_ns) only when the file changed"""
+    # One stat per file and rerun; a missing file is the same check, not an extra exists() call
+    cache = st.session_state.setdefault('data_cache', {})
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        cache.pop(path, None)
+        return default
+    entry = cache.get(path)
+    if entry is None or entry[0] != mtime_ns:
+        entry = cache[path] = (mtime_ns, read(mtime_ns))
+    return entry[1]
+
+def loaded_version(path):
+    """Modification time of the copy of a data file this session loaded, or 0 if it has none"""
+    # The copy's own mtime rather than a fresh stat, so a write landing after the load
+    # cannot pair this copy with the newer version's cache keys
+    entry = st.session_state.get('data_cache', {}).get(path)
+    return entry[0] if entry else 0
+
+def remember_saved(path, data):
+    """Record data just written to a file as this session's copy, so the next rerun skips re-reading it"""
+    st.session_state.setdefault('data_cache', {})[path] = (os.stat(path).st_mtime_ns, data)
+
+def prepare_quizzes(quizzes):
+    """Fill in derived fields missing from quizzes saved before they were stored"""
+    for quiz_data in quizzes.values():
+        if 'answered_count' not in quiz_data:
+            quiz_data['answered_count'] = count_answered(quiz_data['questions'])
+        for question in quiz_data['questions']:
+            if 'option_labels' not in question:
+                question['option_labels'] = option_labels(question['options'])
+    return quizzes
+
+def load_quizzes():
+    """Read quizzes from JSON file, reusing the parsed copy while the file is unchanged"""
+    return session_cached(QUIZZES_FILE, lambda mtime_ns: prepare_quizzes(read_quizzes_file(mtime_ns)), {})
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def read_student_records(mtime_ns):
+    """Read student records from the JSONL file, skipping unusable lines"""
+    # Never rewrite the file here: appends take no lock, so a rewrite could drop a
+    # record appended between the read and the replace
+    records = []
+    with open(STUDENT_RECORDS_FILE, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                records.append(json_loads(line))
+            except ValueError:
+                # A torn line from an interrupted append; the rest of the file is still good
+                pass
+    return records
+
+def option_labels(options):
+    """Display labels ("A: ...") for a question's non-empty options"""
+    return [f"{chr(65+j)}: {option}" for j, option in enumerate(options) if option.strip()]
+
+def count_answered(questions):
+    """Number of questions that have a correct answer set"""
+    return sum(1 for q in questions if q['correct_answer'] is not None)
+
+@st.cache_resource(show_spinner=False)
+def migrate_legacy_records():
+    """Convert the old JSON array of student records to JSONL, once per process"""
+    if os.path.exists(LEGACY_STUDENT_RECORDS_FILE) and not os.path.exists(STUDENT_RECORDS_FILE):
+        with open(LEGACY_STUDENT_RECORDS_FILE, 'rb') as f:
+            write_student_records(json_loads(f.read()))
+        # Keep the old file as a backup rather than deleting it
+        os.replace(LEGACY_STUDENT_RECORDS_FILE, LEGACY_STUDENT_RECORDS_FILE + ".migrated")
+    return True
+
 def load_data():
     """Load data from JSON files"""
     global quizzes_dict, student_records, quiz_counter
     
     try:
         # Load quizzes
-        if os.path.exists(QUIZZES_FILE):
-            with open(QUIZZES_FILE, 'r', encoding='utf-8') as f:
-                quizzes_dict = json.load(f)
-        else:
-            quizzes_dict = {}
+        quizzes_dict = load_quizzes()
         
         # Load student records
-        if os.path.exists(STUDENT_RECORDS_FILE):
-            with open(STUDENT_RECORDS_FILE, 'r', encoding='utf-8') as f:
-                student_records = json.load(f)
-        else:
-            student_records = []
+        migrate_legacy_records()
+        student_records = session_cached(STUDENT_RECORDS_FILE, read_student_records, [])
         
         # Load counter
-        if os.path.exists(COUNTER_FILE):
-            with open(COUNTER_FILE, 'r', encoding='utf-8') as f:
-                counter_data = json.load(f)
-                quiz_counter = counter_data.get('quiz_counter', 0)
-        else:
-            quiz_counter = 0
+        counter_data = session_cached(COUNTER_FILE, lambda mtime_ns: read_json_file(COUNTER_FILE, mtime_ns), {})
+        quiz_counter = counter_data.get('quiz_counter', 0)
             
     except Exception as e:
         st.error(f"Error loading data: {str(e)}")
@@ -77,27 +357,68 @@ def load_data():
         student_records = []
         quiz_counter = 0
 
+@st.cache_resource
+def get_saved_hashes():
+    """Hash of the content last written to each data file, shared across reruns"""
+    return {}
+
+def write_json_file(path, data):
+    """Atomically write data as JSON, skipping the write if the content is unchanged"""
+    if ORJSON_SUPPORT:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    else:
+        payload = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+    
+    saved_hashes = get_saved_hashes()
+    digest = hash(payload)
+    if saved_hashes.get(path) == digest and os.path.exists(path):
+        # Nothing written, so keep the session's copy keyed on the version it came from
+        return
+    
+    replace_file(path, payload)
+    saved_hashes[path] = digest
+    remember_saved(path, data)
+
+def replace_file(path, payload):
+    """Replace a file's contents atomically with the given bytes"""
+    # Write to a temporary file first so a crash or a concurrent reader never sees a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+
 def save_quizzes():
     """Save quizzes to JSON file"""
     try:
-        with open(QUIZZES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(quizzes_dict, f, indent=2, ensure_ascii=False)
+        write_json_file(QUIZZES_FILE, quizzes_dict)
     except Exception as e:
         st.error(f"Error saving quizzes: {str(e)}")
 
-def save_student_records():
-    """Save student records to JSON file"""
+def student_record_line(record):
+    """Serialize one student record as a JSONL line"""
+    if ORJSON_SUPPORT:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+def write_student_records(records):
+    """Write the whole JSONL file; only used to migrate the legacy JSON records"""
+    replace_file(STUDENT_RECORDS_FILE, b"".join(student_record_line(record) for record in records))
+
+def append_student_record(record):
+    """Append one student record to the JSONL file instead of rewriting all of them"""
     try:
-        with open(STUDENT_RECORDS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(student_records, f, indent=2, ensure_ascii=False)
+        # A single write in append mode, so concurrent submissions never interleave
+        with open(STUDENT_RECORDS_FILE, 'ab', buffering=1 << 16) as f:
+            f.write(student_record_line(record))
+        # No remember_saved here: another session may have appended since this one loaded,
+        # so the next rerun re-reads the file rather than pairing this list with its mtime
     except Exception as e:
         st.error(f"Error saving student records: {str(e)}")
 
 def save_counter():
     """Save counter to JSON file"""
     try:
-        with open(COUNTER_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'quiz_counter': quiz_counter}, f, indent=2)
+        write_json_file(COUNTER_FILE, {'quiz_counter': quiz_counter})
     except Exception as e:
         st.error(f"Error saving counter: {str(e)}")
 
@@ -108,50 +429,45 @@ def authenticate_user(username, password):
     else:
         return False, "Invalid username or password!"
 
-def query_huggingface(prompt):
-    """Query Hugging Face API for MCQ generation"""
-    try:
-        headers = {}
-        if HUGGINGFACE_API_KEY:
-            headers["Authorization"] = f"Bearer {HUGGINGFACE_API_KEY}"
-        
-        response = requests.post(
+@st.cache_resource
+def get_http_session():
+    """Shared HTTP session, built once per process so API calls reuse connections"""
+    import requests
+    return requests.Session()
+
+def query_huggingface(prompts, session):
+    """Query Hugging Face API with a batch of prompts, returning one completion per prompt ("" when missing)"""
+    headers = {}
+    if HUGGINGFACE_API_KEY:
+        headers["Authorization"] = f"Bearer {HUGGINGFACE_API_KEY}"
+    
+    for attempt in range(HUGGINGFACE_MAX_ATTEMPTS):
+        response = session.post(
             HUGGINGFACE_API_URL,
             headers=headers,
-            json={"inputs": prompt, "parameters": {"max_length": 500, "temperature": 0.7}}
+            json={"inputs": prompts, "parameters": {"max_length": 500, "temperature": 0.7}},
+            timeout=HUGGINGFACE_TIMEOUT_SECONDS
         )
-        
-        if response.status_code == 200:
-            result = response.json()
-            if isinstance(result, list) and len(result) > 0:
-                return result[0].get('generated_text', '')
-        return ""
-    except Exception as e:
-        st.error(f"Hugging Face API error: {str(e)}")
-        return ""
+        # 503 while the model loads, 429 when rate limited: back off and retry
+        if response.status_code not in (429, 503) or attempt == HUGGINGFACE_MAX_ATTEMPTS - 1:
+            break
+        time.sleep(2 ** attempt)
+    
+    completions = [""] * len(prompts)
+    if response.status_code == 200:
+        result = response.json()
+        if isinstance(result, list) and len(result) == len(prompts):
+            for i, item in enumerate(result):
+                # Batched replies wrap each completion in its own list
+                if isinstance(item, list) and item:
+                    item = item[0]
+                if isinstance(item, dict):
+                    completions[i] = item.get('generated_text', '')
+    return completions
 
-def generate_mcqs_with_ai(text, num_questions=5):
-    """Generate meaningful MCQs using free AI models"""
-    try:
-        # Clean and chunk text
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if len(s.strip()) > 30]
-        
-        if len(sentences) < num_questions:
-            num_questions = len(sentences)
-        
-        questions = []
-        
-        for i in range(num_questions):
-            if i >= len(sentences):
-                break
-                
-            context = sentences[i]
-            if len(context) < 50:  # Skip very short sentences
-                continue
-            
-            # Try to generate question using AI
-            prompt = f"""
+def build_mcq_prompt(context):
+    """Prompt asking the model for one MCQ about a sentence"""
+    return f"""
             Based on this text: "{context}"
             Create one multiple-choice question with 4 options. Make the question meaningful and the options plausible.
             Format exactly as:
@@ -162,10 +478,34 @@ def generate_mcqs_with_ai(text, num_questions=5):
             D) [option D]
             CORRECT: [A/B/C/D]
             """
-            
-            # Try HuggingFace
-            ai_response = query_huggingface(prompt)
-            
+
+def clean_sentences(text):
+    """Split document text into stripped sentences long enough to build a question from"""
+    return tuple(t for t in (s.strip() for s in _SENT_SPLIT_RE.split(text)) if len(t) > 25)
+
+def generate_mcqs_with_ai(text, num_questions=5, sentences=None):
+    """Generate meaningful MCQs using free AI models"""
+    if sentences is None:
+        sentences = clean_sentences(text)
+    
+    try:
+        # The AI path wants slightly longer sentences than the fallback generator
+        candidates = [s for s in sentences if len(s) > 30]
+        
+        questions = []
+        
+        # Skip very short sentences
+        contexts = [context for context in candidates[:num_questions] if len(context) >= 50]
+        
+        # Send every prompt in one request instead of one round trip per sentence
+        ai_responses = [""] * len(contexts)
+        if contexts:
+            try:
+                ai_responses = query_huggingface([build_mcq_prompt(context) for context in contexts], get_http_session())
+            except Exception as e:
+                st.error(f"Hugging Face API error: {str(e)}")
+        
+        for context, ai_response in zip(contexts, ai_responses):
             if ai_response:
                 # Parse AI response
                 question_data = parse_ai_mcq_response(ai_response, context)
@@ -182,7 +522,7 @@ def generate_mcqs_with_ai(text, num_questions=5):
         
     except Exception as e:
         st.error(f"Error generating MCQs with AI: {str(e)}")
-        return generate_mcqs_from_text(text, num_questions)
+        return generate_mcqs_from_text(text, num_questions, sentences)
 
 def parse_ai_mcq_response(ai_response, context):
     """Parse AI response to extract MCQ data"""
@@ -195,13 +535,13 @@ def parse_ai_mcq_response(ai_response, context):
         
         for line in lines:
             if line.lower().startswith('question:') or '?' in line:
-                question_text = re.sub(r'^question:\s*', '', line, flags=re.IGNORECASE)
-            elif re.match(r'^[A-D][).]', line, re.IGNORECASE):
-                option_text = re.sub(r'^[A-D][).]\s*', '', line, flags=re.IGNORECASE)
+                question_text = _QUESTION_PREFIX_RE.sub('', line)
+            elif _OPTION_PREFIX_RE.match(line):
+                option_text = _OPTION_PREFIX_RE.sub('', line)
                 options.append(option_text.strip())
             elif line.lower().startswith('correct:'):
-                correct_letter = re.sub(r'^correct:\s*', '', line, flags=re.IGNORECASE).strip().upper()
-                if correct_letter in ['A', 'B', 'C', 'D']:
+                correct_letter = _CORRECT_PREFIX_RE.sub('', line).strip().upper()
+                if correct_letter in {'A', 'B', 'C', 'D'}:
                     correct_answer = ord(correct_letter) - ord('A')
         
         if question_text and len(options) >= 2 and correct_answer is not None:
@@ -230,30 +570,22 @@ def generate_enhanced_mcq(context):
         if len(words) < 6:
             return None
         
-        # Extract key terms
-        key_terms = [word for word in words if len(word) > 4 and word.lower() not in 
-                    ['which', 'about', 'there', 'their', 'would', 'could']]
+        # Extract key terms (deduplicated, first occurrence wins)
+        key_terms = list(dict.fromkeys(word for word in words if len(word) > 4 and word.lower() not in _STOPWORDS))
         
         if not key_terms:
             key_terms = words[-3:]
         
         # Create different types of questions based on content
-        question_types = [
-            f"What is the main idea conveyed in this text?",
-            f"What key concept is discussed in this passage?",
-            f"Based on the text, what is the primary focus?",
-            f"What important information does this text provide?"
-        ]
-        
-        question_text = question_types[len(key_terms) % len(question_types)]
+        question_text = _QUESTION_TEMPLATES[len(key_terms) % len(_QUESTION_TEMPLATES)]
         
         # Create plausible distractors
-        options = [
-            f"The text discusses {key_terms[0] if key_terms else 'important'} concepts and their significance",
-            f"It focuses on {key_terms[1] if len(key_terms) > 1 else 'key'} aspects and related details",
-            f"The passage describes general information without specific focus",
-            f"It explains technical details about {key_terms[2] if len(key_terms) > 2 else 'various'} topics"
-        ]
+        terms = (
+            key_terms[0] if key_terms else 'important',
+            key_terms[1] if len(key_terms) > 1 else 'key',
+            key_terms[2] if len(key_terms) > 2 else 'various',
+        )
+        options = [template.format(*terms) for template in _ENHANCED_OPTION_TEMPLATES]
         
         return {
             'question_text': question_text,
@@ -267,12 +599,13 @@ def generate_enhanced_mcq(context):
         st.error(f"Error in enhanced MCQ generation: {str(e)}")
         return None
 
-def generate_mcqs_from_text(text, num_questions=5):
+@st.cache_data(show_spinner=False, max_entries=32)
+def generate_mcqs_from_text(text, num_questions=5, sentences=None):
     """Enhanced MCQ generation with better logic"""
+    if sentences is None:
+        sentences = clean_sentences(text)
+    
     try:
-        sentences = re.split(r'[.!?]+', text)
-        sentences = [s.strip() for s in sentences if len(s.strip()) > 25]
-        
         if len(sentences) < num_questions:
             num_questions = len(sentences)
         
@@ -292,12 +625,7 @@ def generate_mcqs_from_text(text, num_questions=5):
             question_text = f"What is the primary subject or main point of this statement: '{sentence[:80]}...'?"
             
             # Generate better options
-            options = [
-                f"The text discusses key concepts and important information",
-                f"It focuses on specific details and technical aspects",
-                f"The passage provides general background and context",
-                f"It explains complex ideas in simple terms"
-            ]
+            options = list(_BASIC_OPTIONS)
             
             questions.append({
                 'question_text': question_text,
@@ -313,6 +641,29 @@ def generate_mcqs_from_text(text, num_questions=5):
         st.error(f"Error generating MCQs: {str(e)}")
         return []
 
+# Uploads are only re-parsed while a teacher iterates on a document, so let entries
+# expire after an hour instead of pinning extracted text for the process lifetime
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def extract_text(file_bytes, extension):
+    """Extract plain text from uploaded PDF or DOCX bytes"""
+    text = ""
+    if extension == '.pdf':
+        if PYMUPDF_SUPPORT:
+            import fitz
+            with fitz.open(stream=file_bytes, filetype="pdf") as pdf_doc:
+                text = "\n".join(page.get_text("text") for page in pdf_doc)
+        else:
+            from PyPDF2 import PdfReader
+            pdf_reader = PdfReader(io.BytesIO(file_bytes))
+            text = "\n".join(t for t in (page.extract_text() for page in pdf_reader.pages) if t)
+    
+    elif extension == '.docx':
+        from docx import Document
+        doc = Document(io.BytesIO(file_bytes))
+        text = "\n".join(p.text for p in doc.paragraphs if p.text.strip())
+    
+    return text
+
 def parse_document(file_obj, generate_mcqs=False):
     """Parse PDF or DOCX file and extract MCQs"""
     global quiz_counter
@@ -321,29 +672,20 @@ def parse_document(file_obj, generate_mcqs=False):
         if file_obj is None:
             return "Please select a file to upload."
         
-        text = ""
         filename = file_obj.name
         
-        try:
-            if filename.endswith('.pdf'):
-                if not PDF_SUPPORT:
-                    return "PDF support not available. Please install PyPDF2."
-                pdf_reader = PdfReader(file_obj)
-                for page in pdf_reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-                    
-            elif filename.endswith('.docx'):
-                if not DOCX_SUPPORT:
-                    return "DOCX support not available. Please install python-docx."
-                doc = Document(file_obj)
-                for paragraph in doc.paragraphs:
-                    if paragraph.text.strip():
-                        text += paragraph.text + "\n"
-            else:
-                return "Unsupported file format. Please upload PDF or DOCX."
+        if filename.endswith('.pdf'):
+            if not PDF_SUPPORT:
+                return "PDF support not available. Please install PyMuPDF or PyPDF2."
+        elif filename.endswith('.docx'):
+            if not DOCX_SUPPORT:
+                return "DOCX support not available. Please install python-docx."
+        else:
+            return "Unsupported file format. Please upload PDF or DOCX."
         
+        try:
+            # Keyed on the file contents, so re-uploading the same file skips extraction
+            text = extract_text(file_obj.getvalue(), os.path.splitext(filename)[1])
         except Exception as e:
             return f"Error reading file: {str(e)}"
         
@@ -353,9 +695,11 @@ def parse_document(file_obj, generate_mcqs=False):
         # Parse or generate MCQs
         if generate_mcqs:
             with st.spinner("🤖 Generating MCQs with AI... This may take a moment."):
-                questions = generate_mcqs_with_ai(text)
+                # Split and clean once and share the sentences with the fallback generator
+                sentences = clean_sentences(text)
+                questions = generate_mcqs_with_ai(text, sentences=sentences)
                 if not questions:
-                    questions = generate_mcqs_from_text(text)
+                    questions = generate_mcqs_from_text(text, sentences=sentences)
                 
                 if not questions:
                     return "Could not generate MCQs from the document."
@@ -367,6 +711,9 @@ def parse_document(file_obj, generate_mcqs=False):
                 return "No MCQs found in the document."
             message = f"✅ Successfully parsed {len(questions)} questions"
         
+        for question in questions:
+            question['option_labels'] = option_labels(question['options'])
+        
         # Create quiz entry
         quiz_counter += 1
         quiz_id = f"quiz_{quiz_counter}"
@@ -378,7 +725,8 @@ def parse_document(file_obj, generate_mcqs=False):
             'filename': filename,
             'enabled': False,
             'auto_generated': generate_mcqs,
-            'duration_minutes': len(questions) * 2
+            'duration_minutes': len(questions) * 2,
+            'answered_count': count_answered(questions)
         }
         
         # Save data
@@ -390,52 +738,42 @@ def parse_document(file_obj, generate_mcqs=False):
     except Exception as e:
         return f"Unexpected error: {str(e)}"
 
+def is_option_line(line):
+    """Check for an 'A.' / 'b)' style option prefix with plain character compares"""
+    return len(line) > 1 and line[0] in 'ABCDabcd' and line[1] in '.)'
+
+def append_parsed_question(questions, question_text, options):
+    """Add a parsed question if it has at least two options, padding them to four"""
+    if question_text and len(options) >= 2:
+        options.extend([""] * (4 - len(options)))
+        questions.append({
+            'question_text': question_text,
+            'options': options,
+            'correct_answer': None,
+            'auto_generated': False
+        })
+
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_mcqs_from_text(text):
     """Extract MCQs from text"""
     questions = []
     
     try:
-        text = re.sub(r'\r\n', '\n', text)
-        text = re.sub(r'\n+', '\n', text)
-        
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        # splitlines handles CRLF and the other line endings; blank lines are dropped here
+        lines = [t for t in (line.strip() for line in text.splitlines()) if t]
         
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            
-            if '?' in line and len(line) > 10:
+        # Single pass: a question line starts a question, up to four option lines are
+        # collected for it, and the next question line (or the end) emits it
+        question_text = None
+        options = []
+        for line in lines:
+            if question_text is not None and len(options) < 4 and is_option_line(line):
+                options.append(line[2:].strip())
+            elif '?' in line and len(line) > 10:
+                append_parsed_question(questions, question_text, options)
                 question_text = line
                 options = []
-                i += 1
-                
-                option_count = 0
-                while i < len(lines) and option_count < 4:
-                    current_line = lines[i]
-                    
-                    if re.match(r'^[A-D][\.\)]', current_line, re.IGNORECASE):
-                        option_text = re.sub(r'^[A-D][\.\)]\s*', '', current_line, flags=re.IGNORECASE)
-                        options.append(option_text.strip())
-                        option_count += 1
-                    elif '?' in current_line and len(current_line) > 10:
-                        break
-                    
-                    i += 1
-                
-                if question_text and len(options) >= 2:
-                    while len(options) < 4:
-                        options.append("")
-                    
-                    questions.append({
-                        'question_text': question_text,
-                        'options': options,
-                        'correct_answer': None,
-                        'auto_generated': False
-                    })
-                else:
-                    i += 1
-            else:
-                i += 1
+        append_parsed_question(questions, question_text, options)
         
         return questions
     
@@ -443,14 +781,20 @@ def parse_mcqs_from_text(text):
         st.error(f"Error parsing MCQs: {str(e)}")
         return []
 
-def get_student_quiz_choices():
-    """Get choices for student quiz dropdown"""
+def quizzes_version():
+    """Version of the loaded quizzes_dict, used as the key for caches derived from it"""
+    return loaded_version(QUIZZES_FILE)
+
+# Keyed only on the quizzes file version, since they read quizzes_dict; older versions
+# are never asked for again, so keep just the newest couple
+@st.cache_data(show_spinner=False, max_entries=2)
+def get_student_quiz_choices(version):
+    """Get choices for student quiz dropdown; version changes whenever the quizzes are saved"""
     choices = []
     for quiz_id, quiz_data in quizzes_dict.items():
         if quiz_data['enabled']:
             total_questions = len(quiz_data['questions'])
-            correct_set = sum(1 for q in quiz_data['questions'] if q['correct_answer'] is not None)
-            if correct_set == total_questions:
+            if quiz_data['answered_count'] == total_questions:
                 duration = quiz_data.get('duration_minutes', total_questions)
                 choices.append((quiz_id, f"📝 {quiz_data['title']} ({total_questions} questions, {duration} minutes)"))
     
@@ -468,6 +812,33 @@ def toggle_quiz_enabled(quiz_id):
         return f"✅ Quiz {status} successfully!"
     return "❌ No quiz selected"
 
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_teacher_quiz_options(version):
+    """Map quiz ids to the teacher panel's edit and enable/disable dropdown labels"""
+    quiz_labels = {}
+    enable_quiz_labels = {}
+    for quiz_id, quiz_data in quizzes_dict.items():
+        total_questions = len(quiz_data['questions'])
+        correct_set = quiz_data['answered_count']
+        status = "✅" if correct_set == total_questions else "⚠️"
+        enabled_status = "🟢" if quiz_data['enabled'] else "🔴"
+        auto_gen = "🤖" if quiz_data.get('auto_generated', False) else "📝"
+        duration = quiz_data.get('duration_minutes', total_questions)
+        quiz_labels[quiz_id] = f"{enabled_status} {auto_gen} {status} {quiz_data['title']} ({correct_set}/{total_questions}) - {duration}min"
+        
+        status = "✅ Ready" if correct_set == total_questions else f"⚠️ {correct_set}/{total_questions} answers set"
+        enable_quiz_labels[quiz_id] = f"{quiz_data['title']} - {status}"
+    
+    return quiz_labels, enable_quiz_labels
+
+def get_answer_key(questions):
+    """Correct answers of a quiz as an int8 array; questions without an answer are -2"""
+    return np.fromiter(
+        (-2 if q['correct_answer'] is None else q['correct_answer'] for q in questions),
+        dtype=np.int8,
+        count=len(questions)
+    )
+
 def submit_student_quiz(quiz_id, student_name, student_email, answers):
     """Process student quiz submission"""
     if not quiz_id or quiz_id not in quizzes_dict:
@@ -476,213 +847,256 @@ def submit_student_quiz(quiz_id, student_name, student_email, answers):
     if not student_name.strip() or not student_email.strip():
         return "❌ Please enter your name and email."
     
-    quiz = quizzes_dict[quiz_id]
-    questions = quiz['questions']
-    
-    score = 0
+    questions = quizzes_dict[quiz_id]['questions']
     total = len(questions)
     
-    for i, question in enumerate(questions):
-        if i < len(answers) and answers[i] is not None and answers[i] == question['correct_answer']:
-            score += 1
+    # answers is an int8 array with -1 for unanswered questions, which never matches the key
+    key = get_answer_key(questions)
+    answered = min(len(answers), total)
+    score = int(np.count_nonzero(answers[:answered] == key[:answered]))
+    
+    record = add_student_record(quiz_id, student_name, student_email, score)
+    
+    result_html = RESULT_TEMPLATE.format_map(record)
+    
+    return result_html, record
+
+def add_student_record(quiz_id, student_name, student_email, score):
+    """Store a student record; a score of None marks an attempt whose answers never arrived"""
+    quiz = quizzes_dict[quiz_id]
+    total = len(quiz['questions'])
+    
+    # 8 hex characters are short enough to read out, so guard against the rare repeat
+    existing_ids = {r['id'] for r in student_records}
+    record_id = token_hex(4)
+    while record_id in existing_ids:
+        record_id = token_hex(4)
     
     record = {
-        'id': str(uuid.uuid4())[:8],
+        'id': record_id,
         'quiz_id': quiz_id,
         'quiz_title': quiz['title'],
         'student_name': student_name.strip(),
         'student_email': student_email.strip(),
-        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
         'score': score,
         'total_questions': total,
-        'percentage': round((score / total) * 100, 2) if total > 0 else 0
+        'percentage': None if score is None else round((score / total) * 100, 2) if total > 0 else 0
     }
     
     student_records.append(record)
-    save_student_records()
+    append_student_record(record)
+    return record
+
+def records_version():
+    """Version of the loaded student_records, used as the key for caches derived from it"""
+    return loaded_version(STUDENT_RECORDS_FILE)
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_results_table(version):
+    """Rows for the teacher's latest-results table; version changes whenever a record is added"""
+    display_data = []
+    # Only the latest 20 are shown, so avoid sorting every record
+    for record in heapq.nlargest(20, student_records, key=lambda x: x['timestamp']):
+        display_data.append({
+            'Student Name': record['student_name'],
+            'Email': record['student_email'],
+            'Quiz': record['quiz_title'],
+            'Score': "⏰ Not submitted" if record['score'] is None else f"{record['score']}/{record['total_questions']} ({record['percentage']}%)",
+            'Date/Time': record['timestamp']
+        })
+    return display_data
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def build_report_bytes(version):
+    """Excel workbook of all student results; version changes whenever a record is added"""
+    rows = (
+        (
+            record['id'],
+            record['student_name'],
+            record['student_email'],
+            record['quiz_title'],
+            record['timestamp'],
+            record['score'],
+            record['total_questions'],
+            "Not submitted" if record['score'] is None else f"{record['percentage']}%"
+        )
+        for record in student_records
+    )
     
-    result_html = f"""
-    <div style="padding: 20px; border: 2px solid #4CAF50; border-radius: 10px; background: #f9fff9;">
-        <h3 style="color: #4CAF50; text-align: center;">🎉 Quiz Completed!</h3>
-        <div style="text-align: center; margin: 20px 0;">
-            <h2>Score: {score}/{total} ({record['percentage']}%)</h2>
-        </div>
-        <div style="background: white; padding: 15px; border-radius: 8px;">
-            <p><strong>Name:</strong> {student_name}</p>
-            <p><strong>Email:</strong> {student_email}</p>
-            <p><strong>Quiz:</strong> {quiz['title']}</p>
-            <p><strong>Date/Time:</strong> {record['timestamp']}</p>
-        </div>
-    </div>
-    """
+    import xlsxwriter
     
-    return result_html, record
+    output = io.BytesIO()
+    # constant_memory flushes each row to a temp file as soon as the next one starts
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    sheet = workbook.add_worksheet('Student Results')
+    sheet.write_row(0, 0, REPORT_COLUMNS, workbook.add_format({'bold': True}))
+    for row_number, row in enumerate(rows, 1):
+        sheet.write_row(row_number, 0, row)
+    workbook.close()
+    return output.getvalue()
 
 def generate_student_report():
     """Generate Excel report of all student results"""
     if not student_records:
         return "❌ No student records found.", None
     
-    data = []
-    for record in student_records:
-        data.append({
-            'Student ID': record['id'],
-            'Student Name': record['student_name'],
-            'Student Email': record['student_email'],
-            'Quiz Title': record['quiz_title'],
-            'Date/Time': record['timestamp'],
-            'Score': record['score'],
-            'Total Questions': record['total_questions'],
-            'Percentage': f"{record['percentage']}%"
-        })
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    filename = f"student_results_{timestamp}.xlsx"
     
-    df = pd.DataFrame(data)
+    return build_report_bytes(records_version()), filename
+
+def render_timer(attempt_id, end_time, warn_at, duration_minutes):
+    """Render the quiz countdown timer"""
+    # The markup only changes when a new quiz starts, so reuse it across ticks;
+    # identical markup also lets the browser keep the running countdown frame.
+    # The time left is taken when the frame is first built; the page keeps the deadline
+    # it derives from it for the rest of the attempt
+    timer_key = (attempt_id, end_time, warn_at, duration_minutes)
+    cached = st.session_state.get('timer_html_cache')
+    if cached is None or cached[0] != timer_key:
+        timer_html = _TIMER_HTML.format(
+            attempt_id=attempt_id,
+            remaining_ms=int(max(0, end_time - time.time()) * 1000),
+            warn_ms=int(warn_at * 1000),
+            duration_minutes=duration_minutes
+        )
+        cached = (timer_key, timer_html)
+        st.session_state.timer_html_cache = cached
+    st.iframe(cached[1], height=150)
+
+@st.fragment(run_every=TIMER_POLL_SECONDS)
+def timer_fragment(duration_minutes):
+    """Rerun only the timer while polling and hand over to a full rerun when the quiz state changes"""
+    end_time = st.session_state.quiz_end_time
+    if (not st.session_state.quiz_active or not end_time or
+            time.time() >= end_time + FORM_SUBMIT_GRACE_SECONDS or
+            not attempt_pending(st.session_state.attempt_id)):
+        # A full app rerun ends the expired quiz and unmounts this fragment,
+        # so no tick keeps polling once the quiz is over
+        st.rerun()
+    render_timer(st.session_state.attempt_id, end_time, st.session_state.quiz_warn_at, duration_minutes)
+
+@st.fragment
+def answer_editor(quiz_id):
+    """Correct-answer editor for one quiz; picking an answer reruns only this fragment"""
+    quiz = quizzes_dict[quiz_id]
+    questions = quiz['questions']
     
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Student Results', index=False)
+    st.markdown(TEACHER_QUIZ_INFO_TEMPLATE.format(
+        title=quiz['title'],
+        total_questions=len(questions),
+        duration_minutes=quiz.get('duration_minutes', len(questions))
+    ), unsafe_allow_html=True)
     
-    output.seek(0)
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"student_results_{timestamp}.xlsx"
+    saved_answers = []
+    for i, question in enumerate(questions):
+        st.subheader(f"Question {i+1}: {question['question_text']}")
+        if question.get('auto_generated', False):
+            st.info("🤖 This question was auto-generated")
+        
+        options = question['option_labels']
+        
+        current_answer = question['correct_answer']
+        
+        correct_answer = st.radio(
+            f"Select correct answer for Question {i+1}",
+            options=range(len(options)) if options else [],
+            format_func=lambda x: options[x] if x < len(options) else "Invalid",
+            index=current_answer if current_answer is not None and current_answer < len(options) else 0,
+            key=f"teacher_{quiz_id}_{i}"
+        )
+        
+        saved_answers.append(correct_answer)
+        st.divider()
     
-    return output, filename
+    if st.button("💾 Save All Answers", type="primary", key="save_answers_btn"):
+        for i, question in enumerate(questions):
+            if i < len(saved_answers):
+                question['correct_answer'] = saved_answers[i]
+        quiz['answered_count'] = count_answered(questions)
+        
+        save_quizzes()
+        st.success(f"✅ Saved all {len(questions)} answers successfully!")
+        st.rerun()
 
-# Initialize session state
-if 'authenticated' not in st.session_state:
-    st.session_state.authenticated = False
-if 'quiz_active' not in st.session_state:
-    st.session_state.quiz_active = False
-if 'current_quiz_id' not in st.session_state:
-    st.session_state.current_quiz_id = None
-if 'student_answers' not in st.session_state:
-    st.session_state.student_answers = {}
-if 'current_student_name' not in st.session_state:
-    st.session_state.current_student_name = ""
-if 'current_student_email' not in st.session_state:
-    st.session_state.current_student_email = ""
-if 'quiz_start_time' not in st.session_state:
-    st.session_state.quiz_start_time = None
-if 'quiz_duration' not in st.session_state:
-    st.session_state.quiz_duration = None
-if 'time_expired' not in st.session_state:
-    st.session_state.time_expired = False
-if 'auto_submitted' not in st.session_state:
-    st.session_state.auto_submitted = False
-if 'quiz_result' not in st.session_state:
-    st.session_state.quiz_result = None
-if 'last_refresh' not in st.session_state:
-    st.session_state.last_refresh = 0
-if 'force_refresh' not in st.session_state:
-    st.session_state.force_refresh = False
-if 'last_auto_refresh' not in st.session_state:
-    st.session_state.last_auto_refresh = 0
-if 'refresh_requested' not in st.session_state:
-    st.session_state.refresh_requested = False
+@st.cache_resource
+def get_attempt_registry():
+    """Process-wide registry of running quiz attempts, shared by all sessions"""
+    return {'lock': threading.Lock(), 'attempts': {}}
 
-# Load data
-load_data()
+def register_attempt(attempt_id, quiz_id, student_name, student_email, end_time):
+    """Track a started attempt and schedule its server-side expiry"""
+    registry = get_attempt_registry()
+    delay = max(0, end_time - time.time()) + AUTO_SUBMIT_GRACE_SECONDS
+    # Hand the registry to the timer thread: it has no script context, and on some
+    # Streamlit versions st.cache_resource returns a fresh object there
+    timer = threading.Timer(delay, expire_attempt, args=(registry, attempt_id))
+    timer.daemon = True
+    with registry['lock']:
+        registry['attempts'][attempt_id] = {
+            'quiz_id': quiz_id,
+            'student_name': student_name,
+            'student_email': student_email,
+            'timer': timer
+        }
+    timer.start()
 
-# Main application
-st.set_page_config(
-    page_title="Digital Pakistan Quiz Management System",
-    page_icon="🎯",
-    layout="wide"
-)
+def attempt_pending(attempt_id):
+    """Check whether an attempt is still waiting to be submitted"""
+    registry = get_attempt_registry()
+    with registry['lock']:
+        return attempt_id in registry['attempts']
 
-# Custom CSS
-st.markdown("""
-<style>
-    .main-header {
-        text-align: center;
-        color: #1f77b4;
-        padding: 20px;
-    }
-    .timer-wrapper {
-        position: fixed;
-        top: 20px;
-        right: 20px;
-        z-index: 9999;
-        text-align: center;
-        background: white;
-        padding: 15px;
-        border-radius: 10px;
-        box-shadow: 0 4px 12px rgba(0,0,0,0.15);
-        border: 2px solid #e0e0e0;
-        min-width: 200px;
-    }
-    .timer-container {
-        background: #4CAF50;
-        color: white;
-        padding: 15px;
-        border-radius: 10px;
-        text-align: center;
-        border: 2px solid #45a049;
-        font-family: Arial, sans-serif;
-        margin-bottom: 10px;
-    }
-    .timer-warning {
-        background: #FF9800 !important;
-        border-color: #ffb74d !important;
-    }
-    .timer-danger {
-        background: #ff4444 !important;
-        border-color: #ff6b6b !important;
-    }
-    .quiz-container {
-        border: 2px solid #2196F3;
-        border-radius: 10px;
-        padding: 20px;
-        margin: 10px 0;
-        background: #f0f8ff;
-    }
-</style>
-""", unsafe_allow_html=True)
+def claim_attempt(attempt_id, registry=None):
+    """Remove an attempt from the registry, returning None if it was already submitted"""
+    if registry is None:
+        registry = get_attempt_registry()
+    with registry['lock']:
+        attempt = registry['attempts'].pop(attempt_id, None)
+    if attempt is not None:
+        attempt['timer'].cancel()
+    return attempt
 
-# Header
-st.markdown("""
-<div class="main-header">
-    <h1>🎯 Digital Pakistan Quiz Management System</h1>
-    <p><strong>Teacher Panel:</strong> Upload quiz documents and set correct answers<br>
-    <strong>Student Panel:</strong> Take quizzes and view results</p>
-</div>
-""", unsafe_allow_html=True)
+def expire_attempt(registry, attempt_id):
+    """Record an attempt whose browser did not submit it by the deadline"""
+    attempt = claim_attempt(attempt_id, registry)
+    if attempt is not None:
+        record_expired_attempt(attempt)
+
+def record_expired_attempt(attempt):
+    """Record an expired attempt without a score, since its answers never reached the server"""
+    # May run outside any script run, so refresh the data this function closes over
+    load_data()
+    if attempt['quiz_id'] not in quizzes_dict:
+        return
+    add_student_record(attempt['quiz_id'], attempt['student_name'], attempt['student_email'], None)
 
-# Improved auto-refresh and auto-submit logic
-if st.session_state.quiz_active and st.session_state.quiz_start_time and st.session_state.quiz_duration:
-    current_time = time.time()
-    elapsed_time = current_time - st.session_state.quiz_start_time
-    remaining_time = max(0, st.session_state.quiz_duration - elapsed_time)
+def submit_current_quiz():
+    """Score the submitted quiz form and reset the quiz session; the form's on_click callback"""
+    quiz_id = st.session_state.current_quiz_id
+    if not st.session_state.quiz_active:
+        return
     
-    if current_time - st.session_state.last_refresh >= 1:
-        st.session_state.last_refresh = current_time
-        
-        if remaining_time <= 0 and not st.session_state.auto_submitted:
-            st.session_state.time_expired = True
-            st.session_state.auto_submitted = True
-            st.session_state.force_refresh = True
-
-if st.session_state.refresh_requested:
-    st.session_state.refresh_requested = False
-    st.session_state.force_refresh = True
-
-current_time = time.time()
-if (st.session_state.quiz_active and 
-    st.session_state.last_auto_refresh and 
-    current_time - st.session_state.last_auto_refresh >= 10):
-    st.session_state.force_refresh = True
-    st.session_state.last_auto_refresh = current_time
-
-if st.session_state.auto_submitted and st.session_state.quiz_active:
-    answers = []
-    if st.session_state.current_quiz_id in quizzes_dict:
-        questions = quizzes_dict[st.session_state.current_quiz_id]['questions']
+    # A form that arrives after the deadline is still scored: the answers are the student's,
+    # and the browser locks the inputs at zero. Claiming cancels the server-side expiry
+    if st.session_state.attempt_id:
+        claim_attempt(st.session_state.attempt_id)
+    
+    # Callbacks run before the script reloads its data, so pick up any answer key
+    # the teacher changed since this session's last rerun
+    load_data()
+    if quiz_id in quizzes_dict:
+        # The callback runs with the submitted form values, read once from the q_{i} widgets
+        questions = quizzes_dict[quiz_id]['questions']
+        answers = np.full(len(questions), -1, dtype=np.int8)
         for i in range(len(questions)):
-            answer_key = f"q_{i}"
-            answers.append(st.session_state.student_answers.get(answer_key))
+            value = st.session_state.get(f"q_{i}")
+            if value is not None:
+                answers[i] = value
         
         result = submit_student_quiz(
-            st.session_state.current_quiz_id,
+            quiz_id,
             st.session_state.current_student_name,
             st.session_state.current_student_email,
             answers
@@ -691,19 +1105,63 @@ if st.session_state.auto_submitted and st.session_state.quiz_active:
         if isinstance(result, tuple) and len(result) == 2:
             result_html, record = result
             st.session_state.quiz_result = result_html
-        
-        st.session_state.quiz_active = False
-        st.session_state.current_quiz_id = None
-        st.session_state.student_answers = {}
-        st.session_state.quiz_start_time = None
-        st.session_state.quiz_duration = None
-        st.session_state.time_expired = False
-        st.session_state.auto_submitted = False
-        st.session_state.last_auto_refresh = 0
-        st.session_state.force_refresh = True
-
-if st.session_state.get('force_refresh', False):
-    st.session_state.force_refresh = False
+    
+    end_quiz_session()
+
+def expire_current_quiz():
+    """End a quiz whose answers never reached the server by the deadline, without scoring it"""
+    if st.session_state.attempt_id:
+        attempt = claim_attempt(st.session_state.attempt_id)
+        if attempt is not None:
+            record_expired_attempt(attempt)
+    st.session_state.quiz_result = QUIZ_EXPIRED_HTML
+    end_quiz_session()
+
+def end_quiz_session():
+    """Clear the running quiz from session state"""
+    st.session_state.quiz_active = False
+    st.session_state.current_quiz_id = None
+    st.session_state.attempt_id = None
+    st.session_state.quiz_duration_minutes = None
+    st.session_state.quiz_end_time = None
+    st.session_state.quiz_warn_at = None
+
+# Initialize session state; every default is immutable, so sharing them is safe
+SESSION_DEFAULTS = {
+    'authenticated': False,
+    'quiz_active': False,
+    'current_quiz_id': None,
+    'attempt_id': None,
+    'current_student_name': "",
+    'current_student_email': "",
+    'quiz_duration_minutes': None,
+    'quiz_end_time': None,
+    'quiz_warn_at': None,
+    'quiz_result': None
+}
+for key, value in SESSION_DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+
+# Load data
+load_data()
+
+# Main application
+st.set_page_config(
+    page_title="Digital Pakistan Quiz Management System",
+    page_icon="🎯",
+    layout="wide"
+)
+
+# Custom CSS and header, sent as a single element
+st.markdown(_PAGE_CHROME_HTML, unsafe_allow_html=True)
+
+# A submitted form is scored by its on_click callback before this point. If the quiz is
+# still active past the deadline (plus the browser's grace to submit), the answers never
+# arrived, so end it unscored before rendering anything else
+if (st.session_state.quiz_active and st.session_state.quiz_end_time and
+        (time.time() >= st.session_state.quiz_end_time + FORM_SUBMIT_GRACE_SECONDS or
+         not attempt_pending(st.session_state.attempt_id))):
+    expire_current_quiz()
     st.rerun()
 
 # Create tabs
@@ -723,7 +1181,7 @@ with tab1:
         if st.button("🔄 Refresh Quiz List"):
             st.rerun()
         
-        student_choices = get_student_quiz_choices()
+        student_choices = get_student_quiz_choices(quizzes_version())
         
         if not student_choices or student_choices[0][0] == "":
             st.warning("❌ No quizzes available. The teacher must enable quizzes and set correct answers first.")
@@ -734,14 +1192,16 @@ with tab1:
             with col2:
                 student_email = st.text_input("Your Email", placeholder="Enter your email address", key="student_email")
             
+            choices_map = dict(student_choices)
             selected_quiz_option = st.selectbox(
                 "Select Quiz to Take",
-                options=[choice[0] for choice in student_choices],
-                format_func=lambda x: dict(student_choices)[x],
+                options=list(choices_map),
+                format_func=choices_map.get,
                 key="student_quiz_select"
             )
             
-            if st.button("Start Quiz", type="primary", key="start_quiz_btn"):
+            # A running quiz must be submitted (or expire) before another can start
+            if st.button("Start Quiz", type="primary", key="start_quiz_btn", disabled=st.session_state.quiz_active):
                 if not student_name.strip() or not student_email.strip():
                     st.error("❌ Please enter your name and email.")
                 else:
@@ -749,127 +1209,66 @@ with tab1:
                     st.session_state.current_quiz_id = selected_quiz_option
                     st.session_state.current_student_name = student_name
                     st.session_state.current_student_email = student_email
-                    st.session_state.student_answers = {}
-                    st.session_state.quiz_start_time = time.time()
                     if selected_quiz_option in quizzes_dict:
                         quiz = quizzes_dict[selected_quiz_option]
-                        st.session_state.quiz_duration = quiz.get('duration_minutes', len(quiz['questions'])) * 60
-                    st.session_state.time_expired = False
-                    st.session_state.auto_submitted = False
+                        st.session_state.quiz_duration_minutes = quiz.get('duration_minutes', len(quiz['questions']))
+                        # Only the deadline is kept; the countdown is computed from it in the browser
+                        duration_seconds = st.session_state.quiz_duration_minutes * 60
+                        st.session_state.quiz_end_time = time.time() + duration_seconds
+                        st.session_state.quiz_warn_at = duration_seconds // 2
+                        if st.session_state.attempt_id:
+                            # Cancel any earlier attempt so its timer cannot record it later
+                            claim_attempt(st.session_state.attempt_id)
+                        st.session_state.attempt_id = token_hex(16)
+                        register_attempt(
+                            st.session_state.attempt_id,
+                            selected_quiz_option,
+                            student_name.strip(),
+                            student_email.strip(),
+                            st.session_state.quiz_end_time
+                        )
                     st.session_state.quiz_result = None
-                    st.session_state.last_refresh = time.time()
-                    st.session_state.last_auto_refresh = time.time()
                     st.rerun()
             
             if st.session_state.quiz_active and st.session_state.current_quiz_id == selected_quiz_option:
                 quiz = quizzes_dict[st.session_state.current_quiz_id]
                 questions = quiz['questions']
-                duration_minutes = quiz.get('duration_minutes', len(questions))
+                duration_minutes = st.session_state.quiz_duration_minutes
                 
-                if st.session_state.quiz_start_time and st.session_state.quiz_duration:
-                    current_time = time.time()
-                    elapsed_time = current_time - st.session_state.quiz_start_time
-                    remaining_time = max(0, st.session_state.quiz_duration - elapsed_time)
-                    minutes = int(remaining_time // 60)
-                    seconds = int(remaining_time % 60)
-                    
-                    timer_class = ""
-                    if remaining_time < 60:
-                        timer_class = "timer-danger"
-                    elif remaining_time < st.session_state.quiz_duration // 2:
-                        timer_class = "timer-warning"
-                    
-                    time_since_refresh = current_time - st.session_state.last_auto_refresh
-                    time_until_refresh = max(0, 10 - time_since_refresh)
-                    
-                    timer_html = f"""
-                    <div class="timer-wrapper">
-                        <div class="timer-container {timer_class}">
-                            <div style="font-size: 14px; font-weight: bold; margin-bottom: 5px;">⏰ QUIZ TIMER</div>
-                            <div style="font-size: 18px; font-weight: bold; font-family: 'Courier New', monospace; margin-bottom: 3px;">
-                                {minutes:02d}:{seconds:02d}
-                            </div>
-                            <div style="font-size: 11px; opacity: 0.9;">
-                                {duration_minutes} minute quiz
-                            </div>
-                            <div style="font-size: 10px; margin-top: 8px; color: #666;">
-                                Auto-refresh in: {int(time_until_refresh)}s
-                            </div>
-                        </div>
-                    </div>
-                    """
-                    st.markdown(timer_html, unsafe_allow_html=True)
-                
-                col1, col2, col3 = st.columns([2, 1, 2])
-                with col2:
-                    if st.button("🔄 Refresh Timer Now", key="manual_refresh_btn", type="primary", use_container_width=True):
-                        st.session_state.refresh_requested = True
-                        st.rerun()
-                
-                if st.session_state.time_expired:
-                    st.error("⏰ TIME'S UP! Your quiz is being submitted...")
+                # Only this fragment reruns while the clock ticks, not the whole script
+                if st.session_state.quiz_end_time:
+                    timer_fragment(duration_minutes)
                 
-                st.markdown(f"""
-                <div class="quiz-container">
-                    <h3>📝 Taking Quiz: {quiz['title']}</h3>
-                    <p><strong>Total Questions:</strong> {len(questions)} | <strong>Time Allowed:</strong> {duration_minutes} minutes</p>
-                    <p><em>Page auto-refreshes every 10 seconds. Use 'Refresh Timer Now' button above for immediate update.</em></p>
-                </div>
-                """, unsafe_allow_html=True)
+                st.markdown(QUIZ_HEADER_TEMPLATE.format(
+                    title=quiz['title'],
+                    total_questions=len(questions),
+                    duration_minutes=duration_minutes
+                ), unsafe_allow_html=True)
                 
-                for i, question in enumerate(questions):
-                    st.subheader(f"Question {i+1}: {question['question_text']}")
-                    
-                    options = []
-                    for j, option in enumerate(question['options']):
-                        if option.strip():
-                            options.append(f"{chr(65+j)}: {option}")
-                    
-                    answer_key = f"q_{i}"
-                    if answer_key not in st.session_state.student_answers:
-                        st.session_state.student_answers[answer_key] = None
-                    
-                    selected_option = st.radio(
-                        f"Select your answer for Question {i+1}:",
-                        options=range(len(options)) if options else [],
-                        format_func=lambda x: options[x] if x < len(options) else "Invalid",
-                        key=answer_key,
-                        index=st.session_state.student_answers[answer_key] if st.session_state.student_answers[answer_key] is not None else 0
-                    )
-                    
-                    st.session_state.student_answers[answer_key] = selected_option
-                    st.divider()
-                
-                st.markdown("---")
-                col1, col2, col3 = st.columns([1, 2, 1])
-                with col2:
-                    if st.button("Submit Quiz", type="primary", key="submit_quiz_btn", use_container_width=True):
-                        answers = []
-                        for i in range(len(questions)):
-                            answer_key = f"q_{i}"
-                            answers.append(st.session_state.student_answers.get(answer_key))
-                        
-                        result = submit_student_quiz(
-                            st.session_state.current_quiz_id,
-                            st.session_state.current_student_name,
-                            st.session_state.current_student_email,
-                            answers
-                        )
+                # Answers only reach the server when the form is submitted, so picking an
+                # option no longer reruns the whole script
+                with st.form("quiz_form", clear_on_submit=False):
+                    for i, question in enumerate(questions):
+                        st.subheader(f"Question {i+1}: {question['question_text']}")
                         
-                        if isinstance(result, tuple) and len(result) == 2:
-                            result_html, record = result
-                            st.session_state.quiz_result = result_html
+                        options = question['option_labels']
                         
-                        st.session_state.quiz_active = False
-                        st.session_state.current_quiz_id = None
-                        st.session_state.student_answers = {}
-                        st.session_state.quiz_start_time = None
-                        st.session_state.quiz_duration = None
-                        st.session_state.time_expired = False
-                        st.session_state.auto_submitted = False
-                        st.session_state.last_auto_refresh = 0
+                        st.radio(
+                            f"Select your answer for Question {i+1}:",
+                            options=range(len(options)) if options else [],
+                            format_func=lambda x: options[x] if x < len(options) else "Invalid",
+                            key=f"q_{i}"
+                        )
                         
-                        st.rerun()
+                        st.divider()
+                    
+                    st.markdown("---")
+                    col1, col2, col3 = st.columns([1, 2, 1])
+                    with col2:
+                        # Scoring in the callback uses the submitted values before the deadline
+                        # check above runs, including when the browser timer presses the button
+                        st.form_submit_button("Submit Quiz", type="primary", width="stretch",
+                                              on_click=submit_current_quiz)
 
 # Teacher Panel
 with tab2:
@@ -908,82 +1307,26 @@ with tab2:
             else:
                 st.error("Please select a file to upload.")
         
+        quiz_labels, enable_quiz_labels = build_teacher_quiz_options(quizzes_version())
+        
         st.subheader("✏️ Set Correct Answers")
         if quizzes_dict:
-            quiz_options = []
-            for quiz_id, quiz_data in quizzes_dict.items():
-                total_questions = len(quiz_data['questions'])
-                correct_set = sum(1 for q in quiz_data['questions'] if q['correct_answer'] is not None)
-                status = "✅" if correct_set == total_questions else "⚠️"
-                enabled_status = "🟢" if quiz_data['enabled'] else "🔴"
-                auto_gen = "🤖" if quiz_data.get('auto_generated', False) else "📝"
-                duration = quiz_data.get('duration_minutes', total_questions)
-                quiz_options.append((quiz_id, f"{enabled_status} {auto_gen} {status} {quiz_data['title']} ({correct_set}/{total_questions}) - {duration}min"))
-            
             selected_quiz_id = st.selectbox(
                 "Select Quiz to Edit",
-                options=[option[0] for option in quiz_options],
-                format_func=lambda x: dict(quiz_options)[x],
+                options=list(quiz_labels),
+                format_func=quiz_labels.get,
                 key="edit_quiz_select"
             )
             
             if selected_quiz_id:
-                quiz = quizzes_dict[selected_quiz_id]
-                questions = quiz['questions']
-                
-                st.markdown(f"""
-                <div style="padding: 15px; border: 2px solid #4CAF50; border-radius: 10px; background: #f9fff9; margin-bottom: 20px;">
-                    <h4>🎯 Setting Correct Answers: {quiz['title']}</h4>
-                    <p><strong>Total Questions:</strong> {len(questions)} | <strong>Duration:</strong> {quiz.get('duration_minutes', len(questions))} minutes</p>
-                </div>
-                """, unsafe_allow_html=True)
-                
-                saved_answers = []
-                for i, question in enumerate(questions):
-                    st.subheader(f"Question {i+1}: {question['question_text']}")
-                    if question.get('auto_generated', False):
-                        st.info("🤖 This question was auto-generated")
-                    
-                    options = []
-                    for j, option in enumerate(question['options']):
-                        if option.strip():
-                            options.append(f"{chr(65+j)}: {option}")
-                    
-                    current_answer = question['correct_answer']
-                    
-                    correct_answer = st.radio(
-                        f"Select correct answer for Question {i+1}",
-                        options=range(len(options)) if options else [],
-                        format_func=lambda x: options[x] if x < len(options) else "Invalid",
-                        index=current_answer if current_answer is not None and current_answer < len(options) else 0,
-                        key=f"teacher_{selected_quiz_id}_{i}"
-                    )
-                    
-                    saved_answers.append(correct_answer)
-                    st.divider()
-                
-                if st.button("💾 Save All Answers", type="primary", key="save_answers_btn"):
-                    for i, question in enumerate(questions):
-                        if i < len(saved_answers):
-                            question['correct_answer'] = saved_answers[i]
-                    
-                    save_quizzes()
-                    st.success(f"✅ Saved all {len(questions)} answers successfully!")
-                    st.rerun()
+                answer_editor(selected_quiz_id)
         
         st.subheader("🎯 Enable/Disable Quizzes")
         if quizzes_dict:
-            enable_quiz_options = []
-            for quiz_id, quiz_data in quizzes_dict.items():
-                total_questions = len(quiz_data['questions'])
-                correct_set = sum(1 for q in quiz_data['questions'] if q['correct_answer'] is not None)
-                status = "✅ Ready" if correct_set == total_questions else f"⚠️ {correct_set}/{total_questions} answers set"
-                enable_quiz_options.append((quiz_id, f"{quiz_data['title']} - {status}"))
-            
             selected_enable_quiz = st.selectbox(
                 "Select Quiz to Toggle",
-                options=[option[0] for option in enable_quiz_options],
-                format_func=lambda x: dict(enable_quiz_options)[x],
+                options=list(enable_quiz_labels),
+                format_func=enable_quiz_labels.get,
                 key="enable_quiz_select"
             )
             
@@ -1005,33 +1348,23 @@ with tab2:
         if student_records:
             st.write(f"**Total Records:** {len(student_records)}")
             
-            display_data = []
-            for record in sorted(student_records, key=lambda x: x['timestamp'], reverse=True)[:20]:
-                display_data.append({
-                    'Student Name': record['student_name'],
-                    'Email': record['student_email'],
-                    'Quiz': record['quiz_title'],
-                    'Score': f"{record['score']}/{record['total_questions']} ({record['percentage']}%)",
-                    'Date/Time': record['timestamp']
-                })
-            
-            df_display = pd.DataFrame(display_data)
-            st.dataframe(df_display, use_container_width=True)
+            st.dataframe(build_results_table(records_version()), width="stretch")
             
             st.write(f"*Showing latest 20 of {len(student_records)} records*")
             
-            if st.button("📥 Download Excel Report", key="download_btn"):
-                excel_data, filename = generate_student_report()
-                if excel_data and filename:
-                    st.download_button(
-                        label="⬇️ Click to Download Student Results (Excel)",
-                        data=excel_data,
-                        file_name=filename,
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                        key="download_excel_btn"
-                    )
-                else:
-                    st.error("Could not generate Excel report.")
+            # The workbook bytes are cached per records version, so offering the
+            # download directly costs nothing until a new record arrives
+            excel_data, filename = generate_student_report()
+            if excel_data and filename:
+                st.download_button(
+                    label="⬇️ Download Student Results (Excel)",
+                    data=excel_data,
+                    file_name=filename,
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    key="download_excel_btn"
+                )
+            else:
+                st.error("Could not generate Excel report.")
         else:
             st.info("📝 No student records yet. Students need to take quizzes first.")
         